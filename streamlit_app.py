@@ -5,6 +5,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 import openpyxl
 import requests
+import hashlib
+import threading
 from openpyxl.styles import PatternFill
 from io import BytesIO
 
@@ -76,6 +78,158 @@ def load_data(file):
     data['Monat_Zahl'] = data['Liefer-Dat.'].dt.month  # Monat als Zahl für die Sortierung
     return data
 
+# Persistente DuckDB-Datei für den letzten Stand und die Statushistorie der Auftragsübersicht
+pfad_auftragshistorie = "auftragshistorie.duckdb"
+
+# Anzahl der Einträge, die in der Statushistorie angezeigt werden
+anzahl_eintraege_historie = 500
+
+# Sperre für das Anlegen der Tabellen, da parallele Sitzungen sonst einen Katalog-Konflikt auslösen
+historie_tabellen_lock = threading.Lock()
+
+# Funktion zum Anlegen der Tabellen für Snapshot, Statushistorie und den zuletzt verarbeiteten Download
+def erstelle_historie_tabellen(hist_conn):
+    with historie_tabellen_lock:
+        hist_conn.execute("""
+            CREATE TABLE IF NOT EXISTS auftrag_snapshot (
+                "Auftrags-Nr." VARCHAR PRIMARY KEY,
+                Zustand VARCHAR,
+                Zustand_seit TIMESTAMP,
+                Zeilen_Hash UBIGINT
+            )
+        """)
+        hist_conn.execute("""
+            CREATE TABLE IF NOT EXISTS auftrag_statushistorie (
+                "Auftrags-Nr." VARCHAR,
+                Aenderung VARCHAR,
+                Zustand_alt VARCHAR,
+                Zustand_neu VARCHAR,
+                Erfasst_am TIMESTAMP
+            )
+        """)
+        # Enthält immer nur eine Zeile (Id = 1) mit dem Hash des zuletzt verarbeiteten Downloads
+        hist_conn.execute("""
+            CREATE TABLE IF NOT EXISTS auftrag_letzter_download (
+                Id INTEGER PRIMARY KEY,
+                Datei_Hash VARCHAR,
+                Erfasst_am TIMESTAMP
+            )
+        """)
+
+# Funktion zum Berechnen eines Hashwerts pro Auftrag (Schlüssel ist die Auftrags-Nr.)
+def berechne_zeilen_hashes(data):
+    # Abgeleitete Spalten (Jahr, Monat, Monat_Zahl) fließen nicht in den Hash ein
+    spalten = [spalte for spalte in data.columns if spalte not in ['Jahr', 'Monat', 'Monat_Zahl']]
+    hashes = pd.DataFrame({
+        'Auftrags-Nr.': data['Auftrags-Nr.'],
+        'Zustand': data['Zustand'],
+        'Zeilen_Hash': pd.util.hash_pandas_object(data[spalten].astype(str), index=False)
+    })
+    # Bei doppelten Auftragsnummern zählt die letzte Zeile
+    return hashes.drop_duplicates(subset='Auftrags-Nr.', keep='last').reset_index(drop=True)
+
+# Funktion zum Vergleich mit dem letzten Stand, wird nur ausgeführt, wenn sich der Download vom vorherigen unterscheidet.
+# Der Snapshot erfasst jede Zeilenänderung, in die Statushistorie kommen nur Zustandswechsel.
+def aktualisiere_statushistorie(file, data, db_pfad=pfad_auftragshistorie):
+    datei_hash = hashlib.sha256(file.getvalue()).hexdigest()
+    erfasst_am = pd.Timestamp.now()
+
+    with duckdb.connect(db_pfad) as hist_conn:
+        erstelle_historie_tabellen(hist_conn)
+
+        # Prüfung, Vergleich, Historie und Snapshot laufen in einer Transaktion
+        hist_conn.execute("BEGIN TRANSACTION")
+        try:
+            letzter_hash = hist_conn.execute(
+                "SELECT Datei_Hash FROM auftrag_letzter_download WHERE Id = 1"
+            ).fetchone()
+            if letzter_hash is not None and letzter_hash[0] == datei_hash:
+                hist_conn.execute("ROLLBACK")
+                return False
+
+            # Zeilen-Hashes nur für einen neuen Download berechnen
+            hist_conn.register('neuer_stand', berechne_zeilen_hashes(data))
+            hist_conn.execute(
+                "INSERT OR REPLACE INTO auftrag_letzter_download VALUES (1, ?, ?)", [datei_hash, erfasst_am]
+            )
+
+            # Unterschiede zum letzten Stand über die Hashwerte ermitteln
+            hist_conn.execute("""
+                CREATE TEMP TABLE deltas AS
+                SELECT
+                    COALESCE(n."Auftrags-Nr.", a."Auftrags-Nr.") AS "Auftrags-Nr.",
+                    CASE
+                        WHEN a."Auftrags-Nr." IS NULL THEN 'neu'
+                        WHEN n."Auftrags-Nr." IS NULL THEN 'entfernt'
+                        ELSE 'geändert'
+                    END AS Aenderung,
+                    a.Zustand AS Zustand_alt,
+                    n.Zustand AS Zustand_neu,
+                    a.Zustand_seit AS Zustand_seit_alt
+                FROM neuer_stand n
+                FULL OUTER JOIN auftrag_snapshot a ON n."Auftrags-Nr." = a."Auftrags-Nr."
+                WHERE n.Zeilen_Hash IS DISTINCT FROM a.Zeilen_Hash
+            """)
+            hist_conn.execute("""
+                INSERT INTO auftrag_statushistorie
+                SELECT "Auftrags-Nr.", Aenderung, Zustand_alt, Zustand_neu, ?::TIMESTAMP
+                FROM deltas
+                WHERE Zustand_alt IS DISTINCT FROM Zustand_neu
+            """, [erfasst_am])
+            # Nur die betroffenen Aufträge im gespeicherten Stand ersetzen, Zustand_seit nur bei Zustandswechsel neu setzen
+            hist_conn.execute("""
+                DELETE FROM auftrag_snapshot
+                WHERE "Auftrags-Nr." IN (SELECT "Auftrags-Nr." FROM deltas)
+            """)
+            hist_conn.execute("""
+                INSERT INTO auftrag_snapshot
+                SELECT
+                    n."Auftrags-Nr.",
+                    n.Zustand,
+                    CASE
+                        WHEN d.Zustand_alt IS DISTINCT FROM d.Zustand_neu THEN ?::TIMESTAMP
+                        ELSE d.Zustand_seit_alt
+                    END,
+                    n.Zeilen_Hash
+                FROM neuer_stand n
+                JOIN deltas d ON n."Auftrags-Nr." = d."Auftrags-Nr."
+            """, [erfasst_am])
+            hist_conn.execute("COMMIT")
+        except (duckdb.TransactionException, duckdb.ConstraintException):
+            # Konflikt mit einer parallelen Sitzung: nichts wird gespeichert, der nächste Durchlauf versucht es erneut.
+            # Scheitert erst das COMMIT, ist die Transaktion bereits beendet und es gibt nichts zurückzurollen.
+            try:
+                hist_conn.execute("ROLLBACK")
+            except duckdb.TransactionException:
+                pass
+            return False
+
+    return True
+
+# Funktion zum Laden der letzten Einträge der Statushistorie, der Anzahl der Änderungen des letzten Downloads
+# und der aktuell gestoppten Aufträge (nur aus dem Snapshot, ohne die Historie zu durchsuchen)
+def lade_statushistorie(db_pfad=pfad_auftragshistorie, anzahl_eintraege=anzahl_eintraege_historie):
+    with duckdb.connect(db_pfad) as hist_conn:
+        erstelle_historie_tabellen(hist_conn)
+        historie = hist_conn.execute("""
+            SELECT * FROM auftrag_statushistorie
+            ORDER BY Erfasst_am DESC, "Auftrags-Nr."
+            LIMIT ?
+        """, [anzahl_eintraege]).df()
+        anzahl_aenderungen = dict(hist_conn.execute("""
+            SELECT Aenderung, COUNT(*)
+            FROM auftrag_statushistorie
+            WHERE Erfasst_am = (SELECT Erfasst_am FROM auftrag_letzter_download WHERE Id = 1)
+            GROUP BY Aenderung
+        """).fetchall())
+        gestoppt = hist_conn.execute("""
+            SELECT "Auftrags-Nr.", Zustand_seit AS Gestoppt_seit
+            FROM auftrag_snapshot
+            WHERE Zustand = 'Gestoppt'
+            ORDER BY Zustand_seit
+        """).df()
+    return historie, anzahl_aenderungen, gestoppt
+
 # Tabs für verschiedene Dashboards
 tab1, tab2, tab3, tab4= st.tabs(["Dashboard 1", "Dashboard 2","Dashboard 3", "Dashboard 4"])
 
@@ -203,6 +357,23 @@ with tab1:
             with st.expander("Data Preview"):
                 st.dataframe(df)
 
+            # Änderungen gegenüber dem letzten Download erfassen und Statushistorie anzeigen
+            aktualisiere_statushistorie(file_dashboard1, df)
+            historie, anzahl_aenderungen, gestoppt = lade_statushistorie()
+
+            with st.expander("Statushistorie"):
+                delta_col1, delta_col2, delta_col3 = st.columns(3)
+                delta_col1.metric(label="Neue Aufträge", value=f"{anzahl_aenderungen.get('neu', 0)}")
+                delta_col2.metric(label="Zustandswechsel", value=f"{anzahl_aenderungen.get('geändert', 0)}")
+                delta_col3.metric(label="Entfernte Aufträge", value=f"{anzahl_aenderungen.get('entfernt', 0)}")
+
+                if not gestoppt.empty:
+                    st.warning(f"{len(gestoppt)} Aufträge befinden sich im Zustand 'Gestoppt'")
+                    st.dataframe(gestoppt)
+
+                st.caption(f"Letzte {anzahl_eintraege_historie} Zustandswechsel")
+                st.dataframe(historie)
+
     else:
         st.error("Die Datei für Dashboard 1 konnte nicht heruntergeladen werden.")
 